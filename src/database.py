@@ -1,12 +1,45 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 DATABASE_URL = 'sqlite+aiosqlite:///./app.db'
 
-engine = create_async_engine(DATABASE_URL, echo=True)
-async_session_maker = sessionmaker(
+# PRAGMA, применяемые к каждому новому соединению с SQLite
+SQLITE_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "temp_store=MEMORY",
+    "cache_size=-64000",
+    "mmap_size=268435456",
+    "foreign_keys=ON",
+)
+
+# Для файловой SQLite aiosqlite по умолчанию использует NullPool
+# (новое соединение на каждый запрос), поэтому пул задаем явно
+engine = create_async_engine(
+    DATABASE_URL,
+    echo=False,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=20,
+    max_overflow=10,
+    pool_timeout=30,
+    pool_pre_ping=True,
+    pool_recycle=3600,
+)
+
+
+@event.listens_for(engine.sync_engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL-журнал и настройки кэша для каждого соединения"""
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+
+
+async_session_maker = async_sessionmaker(
     engine,
-    class_=AsyncSession,
     expire_on_commit=False
 )
 
@@ -1,4 +1,5 @@
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from starlette.responses import JSONResponse
 
 from .database import engine, Base
@@ -7,7 +8,8 @@ from .router import router
 app = FastAPI(
     title="Кулинарная книга API",
     description="API для управления рецептами с полной документацией",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 @app.on_event("startup")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Integer, String, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from .database import Base
 
@@ -6,38 +6,46 @@ from .database import Base
 class RecipeIngredient(Base):
     __tablename__ = "recipe_ingredient"
 
-    recipe_id = Column(Integer, ForeignKey('recipes.id'), primary_key=True)
+    recipe_id = Column(Integer, ForeignKey('recipes.id', ondelete="CASCADE"), primary_key=True)
     recipe = relationship("Recipe", back_populates="recipe_ingredients")
-    ingredient_id = Column(Integer, ForeignKey('ingredients.id'), primary_key=True)
+    ingredient_id = Column(Integer, ForeignKey('ingredients.id', ondelete="CASCADE"), primary_key=True)
     quantity = Column(String(50))
 
 
 class Recipe(Base):
     __tablename__ = "recipes"
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     title = Column(String(100), unique=True, nullable=False)
     description = Column(String(1000))
     cook_time = Column(Integer, nullable=False)
     views = Column(Integer, default=0)
 
+    # Индекс под сортировку списка рецептов (ORDER BY views DESC, cook_time)
+    __table_args__ = (
+        Index("ix_recipes_views_desc_cook", views.desc(), cook_time),
+    )
+
     ingredients = relationship(
         "Ingredient",
         secondary="recipe_ingredient",
         back_populates="recipes",
-        lazy="select"
+        lazy="select",
+        passive_deletes=True
     )
 
     recipe_ingredients = relationship(
         "RecipeIngredient",
-        back_populates="recipe"
+        back_populates="recipe",
+        cascade="all, delete-orphan",
+        passive_deletes=True
     )
 
 
 class Ingredient(Base):
     __tablename__ = "ingredients"
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     title = Column(String(100), unique=True, nullable=False)
 
     recipes = relationship(
@@ -1,6 +1,10 @@
+import time
+from typing import Dict, Tuple
+
 from fastapi import APIRouter, Depends, HTTPException, Response
 from fastapi import Query
-from sqlalchemy import select, delete
+from sqlalchemy import bindparam, delete, insert, lambda_stmt, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload
 
@@ -13,6 +17,54 @@ router = APIRouter(
     tags=["Recipes"]
 )
 
+# Кэш списка рецептов: запись действительна, пока совпадает версия данных и не истек TTL.
+# Создание, изменение и удаление рецептов увеличивают версию в своем процессе; TTL ограничивает
+# устаревание списка при нескольких воркерах и для счетчика просмотров, который кэш не сбрасывает
+RECIPES_CACHE_TTL = 5.0  # секунды
+_recipes_cache: Dict[str, Tuple[int, float, list]] = {}
+_recipes_version = 0
+
+
+def invalidate_recipes_cache():
+    """Сбрасывает кэш списка рецептов после изменения данных"""
+    global _recipes_version
+    _recipes_version += 1
+
+
+# Заранее построенные запросы горячих путей: lambda_stmt кэширует и сборку
+# выражения, и его компиляцию в SQL
+_all_recipes_stmt = lambda_stmt(
+    lambda: select(
+        models.Recipe.id,
+        models.Recipe.title,
+        models.Recipe.description,
+        models.Recipe.cook_time,
+        models.Recipe.views,
+    ).order_by(models.Recipe.views.desc(), models.Recipe.cook_time)
+)
+_recipe_id_by_title_stmt = lambda_stmt(
+    lambda: select(models.Recipe.id).where(models.Recipe.title == bindparam("title"))
+)
+
+
+async def _upsert_ingredient_ids(db: AsyncSession, titles) -> Dict[str, int]:
+    """
+    Создает недостающие ингредиенты одним INSERT ... ON CONFLICT DO NOTHING
+    и одним запросом возвращает ID всех переданных названий
+    """
+    titles = list(dict.fromkeys(titles))
+    await db.execute(
+        sqlite_insert(models.Ingredient)
+        .values([{"title": title} for title in titles])
+        .on_conflict_do_nothing(index_elements=["title"])
+    )
+    result = await db.execute(
+        select(models.Ingredient.id, models.Ingredient.title).where(
+            models.Ingredient.title.in_(titles)
+        )
+    )
+    return {row.title: row.id for row in result.all()}
+
 
 @router.get("/")
 async def get_all_recipes(db: AsyncSession = Depends(get_db)):
@@ -21,9 +73,21 @@ async def get_all_recipes(db: AsyncSession = Depends(get_db)):
     - По убыванию просмотров
     - При одинаковых просмотрах по времени готовки
     """
-    query = select(models.Recipe).order_by(models.Recipe.views.desc(), models.Recipe.cook_time)
-    result = await db.execute(query)
-    return result.scalars().all()
+    cached = _recipes_cache.get("all")
+    if (
+        cached is not None
+        and cached[0] == _recipes_version
+        and time.monotonic() - cached[1] < RECIPES_CACHE_TTL
+    ):
+        return cached[2]
+
+    # Версию запоминаем до запроса: если данные изменятся во время чтения, запись сразу устареет
+    version = _recipes_version
+    # Выбираем только нужные колонки: строки не проходят через identity map ORM
+    result = await db.execute(_all_recipes_stmt)
+    recipes = [dict(row._mapping) for row in result.all()]
+    _recipes_cache["all"] = (version, time.monotonic(), recipes)
+    return recipes
 
 
 @router.get("/{recipe_id}", response_model=schemas.RecipeOut)
@@ -32,28 +96,32 @@ async def get_recipe_detail(recipe_id: int, db: AsyncSession = Depends(get_db)):
      Предоставляет пользователю детальную информацию о рецепте, при этом увеличивает счетчик просмотра"""
 
 
-    query = select(models.Recipe).where(models.Recipe.id == recipe_id).options(
-        selectinload(models.Recipe.ingredients),
-        selectinload(models.Recipe.recipe_ingredients)  # Предварительная загрузка ассоциативной таблицы
+    recipe = await db.get(
+        models.Recipe,
+        recipe_id,
+        options=[
+            selectinload(models.Recipe.ingredients),
+            selectinload(models.Recipe.recipe_ingredients)  # Предварительная загрузка ассоциативной таблицы
+        ]
     )
 
-    result = await db.execute(query)
-    recipe = result.scalar_one_or_none()
-
     if not recipe:
         raise HTTPException(status_code=404, detail="Рецепт не найден")
 
-    recipe.views += 1
+    # Атомарное увеличение счетчика одним UPDATE, без повторного чтения рецепта
+    await db.execute(
+        update(models.Recipe)
+        .where(models.Recipe.id == recipe_id)
+        .values(views=models.Recipe.views + 1)
+        .execution_options(synchronize_session=False)
+    )
     await db.commit()
-    await db.refresh(recipe)
+    recipe.views += 1
 
+    quantities = {ri.ingredient_id: ri.quantity for ri in recipe.recipe_ingredients}
     recipe_dict = recipe.__dict__
     recipe_dict['ingredients'] = [
-        {
-            "id": ing.id,
-            "title": ing.title,
-            "quantity": next((ri.quantity for ri in recipe.recipe_ingredients if ri.ingredient_id == ing.id), None)
-        }
+        {"id": ing.id, "title": ing.title, "quantity": quantities.get(ing.id)}
         for ing in recipe.ingredients
     ]
     return schemas.RecipeOut(**recipe_dict)
@@ -69,9 +137,7 @@ async def create_recipe(
     Post-функция, создает рецепт.
     Валидация на уникальность названия, время готовки должно быть больше 0 минут, а так же минимум 1 ингредиент
     """
-    existing = await db.execute(
-        select(models.Recipe).where(models.Recipe.title == recipe.title)
-    )
+    existing = await db.execute(_recipe_id_by_title_stmt, {"title": recipe.title})
 
     if existing.scalar():
         raise HTTPException(400, "Ошибка! Рецепт с таким названием уже существует")
@@ -83,44 +149,30 @@ async def create_recipe(
         cook_time=recipe.cook_time,
     )
     db.add(new_recipe)
-    await db.commit()
-    await db.refresh(new_recipe)
+    await db.flush()  # Получаем ID рецепта без отдельного коммита
 
     # Добавляем ингредиенты с quantity
-    for ingredient in recipe.ingredients:
-        # Ищем или создаем ингредиент
-        db_ingredient = await db.execute(
-            select(models.Ingredient).where(
-                models.Ingredient.title == ingredient.title
-            )
-        )
-        db_ingredient = db_ingredient.scalar_one_or_none()
-
-        if not db_ingredient:
-            db_ingredient = models.Ingredient(title=ingredient.title)
-            db.add(db_ingredient)
-            await db.commit()
-            await db.refresh(db_ingredient)
-
-        # Создаем связь с quantity
-        association = models.RecipeIngredient(
-            recipe_id=new_recipe.id,
-            ingredient_id=db_ingredient.id,
-            quantity=ingredient.quantity
-        )
-        db.add(association)
-
-    await db.commit()
+    ingredient_ids = await _upsert_ingredient_ids(
+        db, [ingredient.title for ingredient in recipe.ingredients]
+    )
 
-    # Явная загрузка отношений
-    query = select(models.Recipe).where(models.Recipe.id == new_recipe.id).options(
-        selectinload(models.Recipe.ingredients),
-        selectinload(models.Recipe.recipe_ingredients)
+    # Создаем связи с quantity (executemany без unit of work)
+    await db.execute(
+        insert(models.RecipeIngredient),
+        [
+            {
+                "recipe_id": new_recipe.id,
+                "ingredient_id": ingredient_ids[ingredient.title],
+                "quantity": ingredient.quantity,
+            }
+            for ingredient in recipe.ingredients
+        ]
     )
-    result = await db.execute(query)
-    new_recipe = result.scalar_one_or_none()
 
-    # Преобразование ингредиентов в нужный формат перед сериализацией
+    await db.commit()
+    invalidate_recipes_cache()
+
+    # Ответ собираем из уже известных данных, без повторного чтения рецепта
     recipe_dict = {
         "id": new_recipe.id,
         "title": new_recipe.title,
@@ -129,14 +181,11 @@ async def create_recipe(
         "views": new_recipe.views,
         "ingredients": [
             {
-                "id": ing.id,
-                "title": ing.title,
-                "quantity": next(
-                    (ri.quantity for ri in new_recipe.recipe_ingredients if ri.ingredient_id == ing.id),
-                    None
-                )
+                "id": ingredient_ids[ingredient.title],
+                "title": ingredient.title,
+                "quantity": ingredient.quantity
             }
-            for ing in new_recipe.ingredients
+            for ingredient in recipe.ingredients
         ]
     }
 
@@ -152,13 +201,8 @@ async def update_recipe(
     """Patch-функция. Частичное обновление рецепта с ингредиентами"""
 
     try:
-        # Загрузка рецепта с ингредиентами
-        result = await session.execute(
-            select(models.Recipe)
-            .options(selectinload(models.Recipe.recipe_ingredients))
-            .where(models.Recipe.id == recipe_id)
-        )
-        recipe = result.scalar_one_or_none()
+        # Загрузка рецепта (старые связи удаляются одним запросом, загружать их не нужно)
+        recipe = await session.get(models.Recipe, recipe_id)
 
         if not recipe:
             raise HTTPException(status_code=404, detail="Рецепт не найден")
@@ -171,35 +215,61 @@ async def update_recipe(
 
         # Обработка ингредиентов
         if recipe_data.ingredients is not None:
-            # Удаляем старые связи
-            for ri in recipe.recipe_ingredients:
-                await session.delete(ri)
-
-            # Создаём новые
-            for ingredient_in in recipe_data.ingredients:
-                # Поиск или создание ингредиента
-                result = await session.execute(
-                    select(models.Ingredient)
-                    .where(models.Ingredient.title == ingredient_in.title)
-                )
-                ingredient = result.scalar_one_or_none()
-
-                if not ingredient:
-                    ingredient = models.Ingredient(title=ingredient_in.title)
-                    session.add(ingredient)
-                    await session.flush()  # Получаем ID нового ингредиента
-
-                # Создание связи
-                recipe_ingredient = models.RecipeIngredient(
-                    recipe_id=recipe_id,
-                    ingredient_id=ingredient.id,
-                    quantity=ingredient_in.quantity
-                )
-                session.add(recipe_ingredient)
+            # Удаляем старые связи одним запросом
+            await session.execute(
+                delete(models.RecipeIngredient)
+                .where(models.RecipeIngredient.recipe_id == recipe_id)
+            )
+
+            # Создаём новые: ID всех ингредиентов (существующих и новых) за два запроса
+            ingredient_ids = await _upsert_ingredient_ids(
+                session, [ingredient_in.title for ingredient_in in recipe_data.ingredients]
+            )
+
+            # Все связи вставляются одним executemany без unit of work
+            await session.execute(
+                insert(models.RecipeIngredient),
+                [
+                    {
+                        "recipe_id": recipe_id,
+                        "ingredient_id": ingredient_ids[ingredient_in.title],
+                        "quantity": ingredient_in.quantity
+                    }
+                    for ingredient_in in recipe_data.ingredients
+                ]
+            )
 
         await session.commit()
-        await session.refresh(recipe)
-        return recipe
+        invalidate_recipes_cache()
+
+        # Поля рецепта уже актуальны после присваиваний выше; из базы
+        # дочитываем только ингредиенты, если они не пришли в запросе
+        if recipe_data.ingredients is not None:
+            ingredients = [
+                {
+                    "id": ingredient_ids[ingredient_in.title],
+                    "title": ingredient_in.title,
+                    "quantity": ingredient_in.quantity
+                }
+                for ingredient_in in recipe_data.ingredients
+            ]
+        else:
+            result = await session.execute(
+                select(models.Ingredient.id, models.Ingredient.title, models.RecipeIngredient.quantity)
+                .join(models.RecipeIngredient, models.RecipeIngredient.ingredient_id == models.Ingredient.id)
+                .where(models.RecipeIngredient.recipe_id == recipe_id)
+            )
+            ingredients = [dict(row._mapping) for row in result.all()]
+
+        recipe_dict = {
+            "id": recipe.id,
+            "title": recipe.title,
+            "description": recipe.description,
+            "cook_time": recipe.cook_time,
+            "views": recipe.views,
+            "ingredients": ingredients
+        }
+        return schemas.RecipeOut(**recipe_dict)
 
     except HTTPException:
         raise
@@ -215,13 +285,7 @@ async def delete_recipe(
 ):
     """Удаление рецепта с каскадным удалением связей"""
     try:
-        # Поиск рецепта с предварительной загрузкой связей
-        result = await session.execute(
-            select(models.Recipe)
-            .options(selectinload(models.Recipe.recipe_ingredients))
-            .where(models.Recipe.id == recipe_id)
-        )
-        recipe = result.scalar_one_or_none()
+        recipe = await session.get(models.Recipe, recipe_id)
 
         if not recipe:
             raise HTTPException(
@@ -229,14 +293,17 @@ async def delete_recipe(
                 detail="Рецепт не найден"
             )
 
-        # Check if recipe_ingredients is not None before iterating
-        if recipe.recipe_ingredients is not None:
-            for ri in recipe.recipe_ingredients:
-                await session.delete(ri)
+        # Связи удаляем одним запросом: в базах, созданных до ON DELETE CASCADE,
+        # внешний ключ без каскада иначе не даст удалить рецепт
+        await session.execute(
+            delete(models.RecipeIngredient)
+            .where(models.RecipeIngredient.recipe_id == recipe_id)
+        )
 
         # Удаление основного объекта
         await session.delete(recipe)
         await session.commit()
+        invalidate_recipes_cache()
 
         # Возвращаем пустой ответ с кодом 204
         return Response(status_code=204)
@@ -1,124 +1,286 @@
+import asyncio
 import pytest
 import pytest_asyncio
+import orjson
 import os
-from httpx import AsyncClient
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker
+from httpx import ASGITransport, AsyncClient
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import StaticPool
 from src.database import Base, get_db
 from src import models
-from src import schemas
 from src.main import app
+from src.router import invalidate_recipes_cache
 
+try:
+    import uvloop
+except ImportError:  # uvloop не поддерживает Windows
+    uvloop = None
+
+# Тела запросов сериализуются orjson и отправляются как готовые байты
+JSON_HEADERS = {"content-type": "application/json"}
+
+# Тестовые данные: словари и их JSON строятся один раз при импорте модуля
+BASE_RECIPE = {
+    "title": "Тестовый рецепт",
+    "description": "Описание",
+    "cook_time": 30,
+    "ingredients": [{"title": "Ингредиент", "quantity": "100г"}]
+}
+NEW_RECIPE = {**BASE_RECIPE, "title": "Уникальный тестовый рецепт"}
+CACHE_CHECK_RECIPE = {**BASE_RECIPE, "title": "Рецепт для проверки кэша"}
+MULTI_INGREDIENT_RECIPE = {
+    **BASE_RECIPE,
+    "title": "Рецепт с несколькими ингредиентами",
+    "ingredients": [
+        {"title": "Ингредиент", "quantity": "200г"},
+        {"title": "Соль", "quantity": "1 ч.л."},
+        {"title": "Перец", "quantity": "щепотка"},
+    ]
+}
+# Рецепты, которые создаются один раз на всю сессию тестов
+SEED_RECIPES = [
+    {
+        **BASE_RECIPE,
+        "title": f"Тестовый рецепт {i}",
+        "cook_time": 10 * i,
+        "ingredients": [
+            {"title": "Ингредиент", "quantity": "100г"},
+            {"title": "Соль", "quantity": "1 ч.л."},
+        ]
+    }
+    for i in range(1, 4)
+]
+UPDATE_PAYLOAD = {
+    "cook_time": 25,
+    "ingredients": [
+        {"title": "Ингредиент", "quantity": "150г"},
+        {"title": "Укроп", "quantity": "пучок"},
+    ]
+}
+DESCRIPTION_UPDATE_PAYLOAD = {"description": "Новое описание"}
+
+NEW_RECIPE_BODY = orjson.dumps(NEW_RECIPE)
+CACHE_CHECK_RECIPE_BODY = orjson.dumps(CACHE_CHECK_RECIPE)
+MULTI_INGREDIENT_RECIPE_BODY = orjson.dumps(MULTI_INGREDIENT_RECIPE)
+UPDATE_BODY = orjson.dumps(UPDATE_PAYLOAD)
+DESCRIPTION_UPDATE_BODY = orjson.dumps(DESCRIPTION_UPDATE_PAYLOAD)
+
+# Транспорт к ASGI-приложению создается один раз для всех запросов тестов
+transport = ASGITransport(app=app)
+
+# Все тесты и async-фикстуры работают в одном event loop на сессию,
+# чтобы общий AsyncClient и соединение с БД не переходили между циклами
+pytestmark = pytest.mark.asyncio(loop_scope="session")
+
+# Конфигурация тестовой базы данных: in-memory SQLite живет, пока открыто соединение,
+# поэтому StaticPool отдает всем сессиям одно и то же соединение
+TEST_DATABASE_URL = "sqlite+aiosqlite:///:memory:"
+async_engine = create_async_engine(
+    TEST_DATABASE_URL,
+    echo=bool(os.getenv("TEST_SQL_ECHO")),  # Логирование SQL только по запросу
+    connect_args={"check_same_thread": False},
+    poolclass=StaticPool,
+    pool_pre_ping=False,  # Единственное in-memory соединение не нужно проверять
+    pool_recycle=-1  # и пересоздавать: вместе с ним пропала бы вся БД
+)
+
+
+# Тестовой БД не нужна надежность: журнал в памяти и без fsync.
+# Внешние ключи включены, чтобы работало каскадное удаление связей
+TEST_SQLITE_PRAGMAS = (
+    "journal_mode=MEMORY",
+    "synchronous=OFF",
+    "temp_store=MEMORY",
+    "locking_mode=EXCLUSIVE",
+    "foreign_keys=ON",
+)
+
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Настройки SQLite для тестового соединения"""
+    cursor = dbapi_connection.cursor()
+    for pragma in TEST_SQLITE_PRAGMAS:
+        cursor.execute(f"PRAGMA {pragma}")
+    cursor.close()
+    # Отключаем неявный BEGIN драйвера, иначе SAVEPOINT в SQLite работают некорректно
+    dbapi_connection.isolation_level = None
+
+
+@event.listens_for(async_engine.sync_engine, "begin")
+def do_begin(conn):
+    """Транзакцию начинаем явно, вместо драйвера"""
+    conn.exec_driver_sql("BEGIN")
 
-# Конфигурация тестовой базы данных
-TEST_DATABASE_URL = "sqlite+aiosqlite:///./test.db"
-async_engine = create_async_engine(TEST_DATABASE_URL, echo=True)
 
 # Асинхронная сессия
-TestingSessionLocal = sessionmaker(
+TestingSessionLocal = async_sessionmaker(
     async_engine,
-    class_=AsyncSession,
     expire_on_commit=False
 )
 
 
-@pytest_asyncio.fixture(scope="session", autouse=True)
+async def override_get_db():
+    """Переопределяем зависимость get_db для использования тестовой БД"""
+    async with TestingSessionLocal() as session:
+        yield session
+
+
+app.dependency_overrides[get_db] = override_get_db  # Подменяем зависимость один раз при импорте
+
+
+@pytest.fixture(scope="session")
+def event_loop_policy():
+    """Тесты работают на uvloop, если он установлен, иначе на стандартном цикле asyncio"""
+    if uvloop is not None:
+        return uvloop.EventLoopPolicy()
+    return asyncio.DefaultEventLoopPolicy()
+
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session", autouse=True)
 async def setup_db():
     """
     Инициализация и очистка тестовой БД
     Выполняется один раз для всех тестов (scope="session")
     autouse=True - выполняется автоматически
     """
-    # Удаляем файл БД, если он существует
-    if os.path.exists("test.db"):
-        os.remove("test.db")
     async with async_engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)  # Создаем таблицы
     yield
 
-    # Удаляем файл БД после завершения всех тестов
-    if os.path.exists("test.db"):
-        os.remove("test.db")
+    # DROP TABLE не нужен: in-memory БД исчезает вместе с закрытым соединением
+    await async_engine.dispose()
 
 
-@pytest_asyncio.fixture
-async def client():
+@pytest_asyncio.fixture(loop_scope="session", autouse=True)
+async def db_transaction():
     """
-    Фикстура для HTTP-клиента с подменой зависимости БД
+    Каждый тест выполняется во внешней транзакции, которая откатывается после теста.
+    Сессии приложения привязываются к этому соединению, а их commit
+    фиксирует только SAVEPOINT (join_transaction_mode="create_savepoint")
     """
-    async def override_get_db():
-        """Переопределяем зависимость get_db для использования тестовой БД"""
-        async with TestingSessionLocal() as session:
-            yield session
+    async with async_engine.connect() as conn:
+        transaction = await conn.begin()
+        TestingSessionLocal.configure(bind=conn, join_transaction_mode="create_savepoint")
+        yield conn
+        await transaction.rollback()
+    TestingSessionLocal.configure(bind=async_engine, join_transaction_mode="conditional_savepoint")
+    invalidate_recipes_cache()  # Кэш списка рецептов не должен пережить откат
 
-    app.dependency_overrides[get_db] = override_get_db  # Подменяем зависимость
-    async with AsyncClient(app=app, base_url="http://test") as client:
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def client(setup_db):
+    """
+    Фикстура для HTTP-клиента
+    Один клиент на все тесты (scope="session")
+    """
+    async with AsyncClient(transport=transport, base_url="http://test") as client:
+        # Прогревочный запрос: маршрутизация, валидация и первое обращение к БД
+        # выполняются здесь, а не во времени первого теста
+        await client.get("/recipes/")
         yield client
 
 
-@pytest.mark.asyncio
+def sorted_by_id(ingredients):
+    """Порядок ингредиентов в ответе не гарантирован, сравниваем их отсортированными по id"""
+    return sorted(ingredients, key=lambda ing: ing["id"])
+
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def seeded_recipes(setup_db):
+    """
+    Создает рецепты один раз для тестов чтения, обновления и удаления.
+    Изменения этих рецептов внутри тестов откатываются фикстурой db_transaction.
+    Данные пишутся напрямую через ORM одним коммитом, без POST-запросов к API.
+    Возвращает рецепты в том же виде, что и ответ API
+    """
+    async with TestingSessionLocal() as session:
+        ingredients = {
+            ingredient["title"]: models.Ingredient(title=ingredient["title"])
+            for recipe_data in SEED_RECIPES
+            for ingredient in recipe_data["ingredients"]
+        }
+        session.add_all(ingredients.values())
+        await session.flush()  # Получаем ID ингредиентов для связей
+
+        recipes = [
+            models.Recipe(
+                title=recipe_data["title"],
+                description=recipe_data["description"],
+                cook_time=recipe_data["cook_time"],
+                recipe_ingredients=[
+                    models.RecipeIngredient(
+                        ingredient_id=ingredients[ingredient["title"]].id,
+                        quantity=ingredient["quantity"]
+                    )
+                    for ingredient in recipe_data["ingredients"]
+                ]
+            )
+            for recipe_data in SEED_RECIPES
+        ]
+        session.add_all(recipes)
+        await session.commit()
+    invalidate_recipes_cache()
+
+    return [
+        {
+            "id": recipe.id,
+            "title": recipe.title,
+            "description": recipe.description,
+            "cook_time": recipe.cook_time,
+            "views": recipe.views,
+            "ingredients": [
+                {
+                    "id": ingredients[ingredient["title"]].id,
+                    "title": ingredient["title"],
+                    "quantity": ingredient["quantity"]
+                }
+                for ingredient in recipe_data["ingredients"]
+            ]
+        }
+        for recipe, recipe_data in zip(recipes, SEED_RECIPES)
+    ]
+
+
 async def test_read_recipes(client):
     """Тест GET-запроса (получение всех рецептов)"""
     response = await client.get("/recipes/")
     assert response.status_code == 200
-    data = response.json()
+    data = orjson.loads(response.content)
     assert isinstance(data, list)
 
 
-@pytest.mark.asyncio
-async def test_read_recipe_by_id(client):
-    """Тест GET-запроса по id (получение рецепта по ID)"""
-    # Сначала создаем рецепт, чтобы его потом получить
-    recipe_data = {
-        "title": "Тестовый рецепт для ID",
-        "description": "Описание",
-        "cook_time": 40,
-        "ingredients": [{"title": "Ингредиент", "quantity": "100г"}]
-    }
-    create_resp = await client.post("/recipes/", json=recipe_data)
-    assert create_resp.status_code == 200
-    recipe_id = create_resp.json()["id"]
+@pytest.mark.parametrize("index", range(len(SEED_RECIPES)))
+async def test_read_recipe_by_id(client, seeded_recipes, index):
+    """Тест GET-запроса по id (получение рецепта по ID)
+    Рецепт уже создан фикстурой, поэтому тест делает только GET и сверяет его с засеянными данными"""
+    seeded = seeded_recipes[index]
 
-    response = await client.get(f"/recipes/{recipe_id}")
+    response = await client.get(f"/recipes/{seeded['id']}")
     assert response.status_code == 200
-    data = response.json()
-    assert data["id"] == recipe_id
-    assert data["title"] == "Тестовый рецепт для ID"
+    data = orjson.loads(response.content)
+    assert {**data, "ingredients": sorted_by_id(data["ingredients"])} == {
+        **seeded,
+        "views": seeded["views"] + 1,
+        "ingredients": sorted_by_id(seeded["ingredients"]),
+    }
 
 
-@pytest.mark.asyncio
 async def test_create_recipe(client):
     """Тест POST-запроса (создание нового рецепта)"""
-    recipe_data = {
-        "title": "Уникальный тестовый рецепт",
-        "description": "Описание теста",
-        "cook_time": 30,
-        "ingredients": [{"title": "Ингредиент", "quantity": "100г"}]
-    }
-
-    response = await client.post("/recipes/", json=recipe_data)
+    response = await client.post("/recipes/", content=NEW_RECIPE_BODY, headers=JSON_HEADERS)
     assert response.status_code == 200, (f"Expected 200, but got {response.status_code}. "
                                          f"Response text: {response.text}")  # Выводим текст ответа при ошибке
-    data = response.json()
+    data = orjson.loads(response.content)
 
-    assert data["title"] == recipe_data["title"]
-    assert data["cook_time"] == recipe_data["cook_time"]
+    assert data["title"] == NEW_RECIPE["title"]
+    assert data["cook_time"] == NEW_RECIPE["cook_time"]
 
 
-@pytest.mark.asyncio
-async def test_delete_recipe(client):
+async def test_delete_recipe(client, seeded_recipes):
     """Тест DELETE-запроса (удаление рецепта)"""
-
-    recipe_data = {
-        "title": "Для удаления",
-        "description": "Описание",
-        "cook_time": 40,
-        "ingredients": [{"title": "Ингредиент", "quantity": "100г"}]
-    }
-    create_resp = await client.post("/recipes/", json=recipe_data)
-    assert create_resp.status_code == 200
-    recipe_id = create_resp.json()["id"]
+    recipe_id = seeded_recipes[0]["id"]
 
     response = await client.delete(f"/recipes/{recipe_id}")
     assert response.status_code == 204, (f"Expected 204, but got {response.status_code}."
@@ -126,3 +288,65 @@ async def test_delete_recipe(client):
 
     response = await client.get(f"/recipes/{recipe_id}")
     assert response.status_code == 404
+
+    # Связи с ингредиентами удалены каскадно
+    async with TestingSessionLocal() as session:
+        result = await session.execute(
+            select(models.RecipeIngredient).where(models.RecipeIngredient.recipe_id == recipe_id)
+        )
+        assert result.scalars().all() == []
+
+
+async def test_create_recipe_reuses_ingredients(client):
+    """Тест POST-запроса с несколькими ингредиентами (существующими и новыми)"""
+    response = await client.post("/recipes/", content=MULTI_INGREDIENT_RECIPE_BODY, headers=JSON_HEADERS)
+    assert response.status_code == 200, (f"Expected 200, but got {response.status_code}. "
+                                         f"Response text: {response.text}")
+    ingredients = {ing["title"]: ing["quantity"] for ing in orjson.loads(response.content)["ingredients"]}
+
+    assert ingredients == {"Ингредиент": "200г", "Соль": "1 ч.л.", "Перец": "щепотка"}
+
+
+async def test_update_recipe(client, seeded_recipes):
+    """Тест PATCH-запроса (замена ингредиентов рецепта)"""
+    recipe_id = seeded_recipes[1]["id"]
+
+    response = await client.patch(f"/recipes/{recipe_id}", content=UPDATE_BODY, headers=JSON_HEADERS)
+    assert response.status_code == 200, (f"Expected 200, but got {response.status_code}. "
+                                         f"Response text: {response.text}")
+    data = orjson.loads(response.content)
+    ingredients = {ing["title"]: ing["quantity"] for ing in data["ingredients"]}
+
+    assert data["cook_time"] == UPDATE_PAYLOAD["cook_time"]
+    assert data["title"] == SEED_RECIPES[1]["title"]
+    assert ingredients == {"Ингредиент": "150г", "Укроп": "пучок"}
+
+
+async def test_read_recipes_after_create(client):
+    """Тест GET-запроса: список рецептов обновляется после создания нового рецепта"""
+    await client.get("/recipes/")  # Заполняем кэш списка
+
+    create_resp = await client.post("/recipes/", content=CACHE_CHECK_RECIPE_BODY, headers=JSON_HEADERS)
+    assert create_resp.status_code == 200
+
+    response = await client.get("/recipes/")
+    assert response.status_code == 200
+    assert CACHE_CHECK_RECIPE["title"] in [recipe["title"] for recipe in orjson.loads(response.content)]
+
+
+async def test_update_recipe_without_ingredients(client, seeded_recipes):
+    """Тест PATCH-запроса без ингредиентов: связи рецепта сохраняются"""
+    recipe = seeded_recipes[2]
+    recipe_id = recipe["id"]
+
+    response = await client.patch(
+        f"/recipes/{recipe_id}", content=DESCRIPTION_UPDATE_BODY, headers=JSON_HEADERS
+    )
+    assert response.status_code == 200, (f"Expected 200, but got {response.status_code}. "
+                                         f"Response text: {response.text}")
+    data = orjson.loads(response.content)
+
+    assert data["description"] == DESCRIPTION_UPDATE_PAYLOAD["description"]
+    assert sorted_by_id(data["ingredients"]) == sorted_by_id(recipe["ingredients"])
+
+